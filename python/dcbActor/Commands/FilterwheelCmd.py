@@ -23,8 +23,9 @@ class FilterwheelCmd(object):
         #
         self.vocab = [
             ('filterwheel', 'status', self.status),
+            ('filterwheel', 'timing [@reset]', self.timing),
             ('filterwheel', 'init', self.initWheel),
-            ('set', '@(<linewheel>|<qthwheel>)', self.moveWheel),
+            ('set', '@(<linewheel>|<qthwheel>) [@force] [@noWait]', self.moveWheel),
             ('init', '@(linewheel|qthwheel)', self.initWheel),
             ('adc', 'calib', self.adcCalib),
 
@@ -62,31 +63,53 @@ class FilterwheelCmd(object):
         """Report state, mode, status."""
         self.controller.generate(cmd)
 
-    @blocking
+    def timing(self, cmd):
+        """Report filterwheel i/o statistics, reset them if required."""
+        cmdKeys = cmd.cmd.keywords
+        self.controller.ioStats.genKeys(cmd)
+
+        if 'reset' in cmdKeys:
+            self.controller.ioStats.reset()
+            cmd.inform('text="filterwheel timing statistics reset"')
+
+        cmd.finish()
+
     def moveWheel(self, cmd):
-        """set linewheel to required position."""
+        """set linewheel to required position, in the background if noWait is specified."""
         cmdKeys = cmd.cmd.keywords
-        if 'linewheel' in cmdKeys:
-            wheel = 'linewheel'
-            holeDict = self.controller.lineHoles
+
+        if 'noWait' in cmdKeys:
+            self.moveWheelNoWait(cmd)
         else:
-            wheel = 'qthwheel'
-            holeDict = self.controller.qthHoles
+            self.moveWheelBlocking(cmd)
 
-        revHoleDict = dict([(v, k) for k, v in holeDict.items()])
-        existingHoles = ",".join([str(key) for key in revHoleDict.keys()])
+    def resolveMove(self, cmd):
+        """Return required wheel, hole and position."""
+        cmdKeys = cmd.cmd.keywords
+        wheel = 'linewheel' if 'linewheel' in cmdKeys else 'qthwheel'
         hole = cmdKeys[wheel].values[0]
+        position = self.controller.resolveHole(wheel, hole)
 
-        if hole not in revHoleDict.keys():
-            try:
-                hole = '{:.1f}'.format(float(hole))
-                position = revHoleDict[hole]
-            except:
-                raise ValueError(f'unknown hole:{hole}, existing are {existingHoles}')
+        return wheel, hole, position
 
-        position = revHoleDict[hole]
-        self.controller.substates.move(wheel=wheel, position=position, cmd=cmd)
-        self.controller.generate(cmd)
+    def doMove(self, cmd):
+        """Request the move, return False if it has been queued behind an ongoing move."""
+        cmdKeys = cmd.cmd.keywords
+        wheel, hole, position = self.resolveMove(cmd)
+
+        return self.controller.requestMove(cmd, wheel, position, force='force' in cmdKeys)
+
+    @blocking
+    def moveWheelBlocking(self, cmd):
+        """set wheel to required position, blocking the filterwheel command queue."""
+        if self.doMove(cmd):
+            self.controller.generate(cmd)
+
+    @singleShot
+    def moveWheelNoWait(self, cmd):
+        """set wheel to required position from its own thread, the command finishes when the move is done."""
+        if self.doMove(cmd):
+            self.controller.generate(cmd)
 
     @blocking
     def initWheel(self, cmd):
@@ -23,6 +23,7 @@ class TopCmd(object):
             ('ping', '', self.ping),
             ('status', '[@all] [<controllers>]', self.status),
             ('monitor', '<controllers> <period>', self.monitor),
+            ('hotReload', '', self.hotReload),
             ('config', '<fibers>', self.declareBundles),
             ('declareMasks', f'{collSets} [<colls>]', self.declareMasks),
             ('declareMasks', f'<install> [<into>] [<colls>]', self.declareMasks),
@@ -100,6 +101,8 @@ class TopCmd(object):
         """Report camera status and actor version. """
         cmdKeys = cmd.cmd.keywords
         self.actor.sendVersionKey(cmd)
+        if self.actor.startupTime is not None:
+            cmd.inform(f'startupTime={self.actor.startupTime:0.3f}')
         cmd.inform('text=%s' % "Present!")
         cmd.inform('text="monitors: %s"' % self.actor.monitors)
         cmd.inform('text="config id=0x%08x %r"' % (id(self.actor.actorConfig), self.actor.actorConfig.keys()))
@@ -114,11 +117,17 @@ class TopCmd(object):
                 self.actor.callCommand("%s status" % controller)
 
         if not self.dcbConfig:
-            self.actor.reloadConfiguration()
+            self.actor.reloadConfiguration(cmd)
+        else:
+            self.dcbConfig.genKeys(cmd)
 
-        self.dcbConfig.genKeys(cmd)
         cmd.finish(self.controllerKey())
 
+    def hotReload(self, cmd):
+        """Reload dcb modules and shared lamps commands, then regenerate the configuration keywords."""
+        self.actor.hotReload(cmd)
+        cmd.finish()
+
     def declareMasks(self, cmd):
         def retrieveFNumber(vals):
             fNumbers = []
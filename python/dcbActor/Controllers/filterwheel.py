@@ -1,19 +1,155 @@
 __author__ = 'alefur'
 
 import logging
+import re
+import threading
 import time
-from importlib import reload
 
 import dcbActor.Simulators.filterwheel as simulator
 import ics.utils.tcp.bufferedSocket as bufferedSocket
 from ics.utils.fsm.fsmThread import FSMThread
 
-reload(simulator)
+
+class EndBlockFailed(RuntimeError):
+    """Raised when the controller reports a failure while waiting for an end block."""
+
+
+class EndBlock(object):
+    """Compiled end block matcher, with success and failure regexes."""
+
+    def __init__(self, success, failure=()):
+        success = [success] if isinstance(success, str) else list(success)
+        failure = [failure] if isinstance(failure, str) else list(failure)
+
+        self.successPatterns = success
+        self.failurePatterns = failure
+        self.success = re.compile('|'.join(f'(?:{pattern})' for pattern in success))
+        self.failure = re.compile('|'.join(f'(?:{pattern})' for pattern in failure)) if failure else None
+
+    @classmethod
+    def literal(cls, endBlock):
+        """Matcher for plain end block string(s), no failure pattern."""
+        endBlocks = [endBlock] if isinstance(endBlock, str) else list(endBlock)
+        return cls([re.escape(block) for block in endBlocks])
+
+    def expecting(self, success):
+        """Same failure patterns, different success pattern(s)."""
+        return EndBlock(success, failure=self.failurePatterns)
+
+    def match(self, line):
+        """Return True if line is a success end block.
+
+        :raise: EndBlockFailed if line matches a failure pattern.
+        """
+        if self.failure is not None and self.failure.search(line):
+            raise EndBlockFailed(line)
+
+        return self.success.search(line) is not None
+
+
+class IoStats(object):
+    """Per operation counts, bytes, latencies and timeouts of the controller i/o."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = dict()
+
+    def reset(self):
+        with self.lock:
+            self.stats = dict()
+
+    def record(self, operation, latency, nBytes=0, timeout=False):
+        """Accumulate one call of operation."""
+        with self.lock:
+            count, totBytes, totLatency, maxLatency, nTimeouts = self.stats.get(operation, (0, 0, 0., 0., 0))
+            self.stats[operation] = (count + 1, totBytes + nBytes, totLatency + latency, max(maxLatency, latency),
+                                     nTimeouts + int(timeout))
+
+    def report(self):
+        """Statistics per operation, latencies in ms."""
+        with self.lock:
+            stats = dict(self.stats)
+
+        return dict([(operation, dict(count=count, bytes=totBytes, meanMs=1000 * totLatency / count,
+                                      maxMs=1000 * maxLatency, timeouts=nTimeouts))
+                     for operation, (count, totBytes, totLatency, maxLatency, nTimeouts) in stats.items()])
+
+    def genKeys(self, cmd):
+        """Generate one filterwheelTiming keyword per operation.
+
+        :param cmd: current command.
+        """
+        for operation, stats in self.report().items():
+            cmd.inform(f'filterwheelTiming={operation},{stats["count"]},{stats["bytes"]},'
+                       f'{stats["meanMs"]:.3f},{stats["maxMs"]:.3f},{stats["timeouts"]}')
+
+
+class PositionCache(object):
+    """Write-through cache of the wheel positions, reads are served from memory and writes persisted in the background.
+
+    Writes happening within flushDelay are batched into a single persistence pass.
+    """
+
+    def __init__(self, actorData, wheels, flushDelay=0.2):
+        self.actorData = actorData
+        self.wheels = wheels
+        self.flushDelay = flushDelay
+        self.positions = dict([(wheel, -1) for wheel in wheels])
+        self.dirty = set()
+        self.timer = None
+        self.lock = threading.Lock()
+        self.persistLock = threading.Lock()
+
+    def reconcile(self):
+        """Flush pending writes, then reload positions from instdata."""
+        self.flush()
+
+        for wheel in self.wheels:
+            try:
+                position, = self.actorData.loadKey(wheel)
+            except:
+                position = -1
+
+            with self.lock:
+                self.positions[wheel] = position
+
+    def get(self, wheel):
+        with self.lock:
+            return self.positions[wheel]
+
+    def set(self, wheel, position):
+        """Update position in memory, schedule its persistence."""
+        with self.lock:
+            self.positions[wheel] = position
+            self.dirty.add(wheel)
+
+            if self.timer is None:
+                self.timer = threading.Timer(self.flushDelay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Persist pending positions."""
+        with self.persistLock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+                pending = dict([(wheel, self.positions[wheel]) for wheel in self.dirty])
+                self.dirty.clear()
+
+            for wheel, position in pending.items():
+                self.actorData.persistKey(wheel, position)
 
 
 class filterwheel(FSMThread, bufferedSocket.EthComm):
     wheelPortConfig = dict(dcb=dict(linewheel=1, qthwheel=0),
                            dcb2=dict(linewheel=0, qthwheel=1))
+    # end block matchers per operation, see registerEndBlock.
+    endBlocks = dict(calibrate=EndBlock('Done', failure='CALIBRATE FAILED'),
+                     move=EndBlock('Moved to position', failure='FAILED'),
+                     adccalib=EndBlock('Zeros for channel', failure='FAILED'))
 
     def __init__(self, actor, name, loglevel=logging.DEBUG):
         """This sets up the connections to/from the hub, the logger, and the twisted reactor.
@@ -31,7 +167,20 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         FSMThread.__init__(self, actor, name, events=events, substates=substates)
 
         self.addStateCB('MOVING', self.moving)
-        self.sim = simulator.FilterwheelSim(self.actor.name)
+        # simulator, created in _loadCfg.
+        self.sim = None
+        # whether the server answers to the batched adc request, probed in _testComm.
+        self.batchedAdc = True
+        # a request and its whole answer are read under that lock, moves can run outside the controller thread.
+        self.ioLock = threading.RLock()
+        # most recent pending target per wheel, executed once the ongoing move is done.
+        self.pendingMoves = dict()
+        self.moveOngoing = False
+        self.moveQueueLock = threading.Lock()
+        # i/o instrumentation, reported by getStatus.
+        self.ioStats = IoStats()
+        self.holeTablesCache = None
+        self.positionCache = PositionCache(self.actor.actorData, ['linewheel', 'qthwheel'])
 
         self.logger = logging.getLogger(self.name)
         self.logger.setLevel(loglevel)
@@ -48,11 +197,68 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
 
     @property
     def lineHoles(self):
-        return dict([(i + 1, str(h).strip()) for i, h in enumerate(self.controllerConfig['lineHoles'])])
+        return self.holeTables['linewheel'][0]
 
     @property
     def qthHoles(self):
-        return dict([(i + 1, str(h).strip()) for i, h in enumerate(self.controllerConfig['qthHoles'])])
+        return self.holeTables['qthwheel'][0]
+
+    @property
+    def holeTables(self):
+        """Forward (position->hole) and reverse (hole->position) tables per wheel, built once per config load."""
+        if self.holeTablesCache is None:
+            self.holeTablesCache = dict(linewheel=self.buildHoleTables(self.controllerConfig['lineHoles']),
+                                        qthwheel=self.buildHoleTables(self.controllerConfig['qthHoles']))
+        return self.holeTablesCache
+
+    @staticmethod
+    def buildHoleTables(configHoles):
+        """Build forward and reverse hole tables, numeric holes are also indexed by their normalized forms (3, 3.0).
+
+        :param configHoles: hole per wheel position.
+        """
+        holes = dict([(i + 1, str(h).strip()) for i, h in enumerate(configHoles)])
+        revHoles = dict()
+
+        for position, hole in holes.items():
+            try:
+                value = float(hole)
+            except ValueError:
+                continue
+            aliases = ['{:.1f}'.format(value), str(value)] + ([str(int(value))] if value.is_integer() else [])
+            revHoles.update([(alias, position) for alias in aliases])
+
+        # actual hole names take precedence over normalized forms.
+        revHoles.update([(hole, position) for position, hole in holes.items()])
+        return holes, revHoles
+
+    def resolveHole(self, wheel, hole):
+        """Return wheel position for a given hole.
+
+        :param wheel: linewheel|qthwheel
+        :param hole: hole name, numeric holes can be given in any float format.
+        :raise: ValueError if hole is unknown.
+        """
+        holes, revHoles = self.holeTables[wheel]
+
+        if hole in revHoles:
+            return revHoles[hole]
+
+        try:
+            return revHoles['{:.1f}'.format(float(hole))]
+        except (ValueError, KeyError):
+            existingHoles = ",".join(dict([(v, k) for k, v in holes.items()]).keys())
+            raise ValueError(f'unknown hole:{hole}, existing are {existingHoles}')
+
+    @classmethod
+    def registerEndBlock(cls, operation, success, failure=()):
+        """Register success and failure regexes for a given operation.
+
+        :param operation: calibrate|move|adccalib.
+        :param success: regex or list of regexes ending the wait.
+        :param failure: regex or list of regexes failing the operation straight away.
+        """
+        cls.endBlocks[operation] = EndBlock(success, failure=failure)
 
     def _loadCfg(self, cmd, mode=None):
         """Load filterwheel configuration.
@@ -64,6 +270,12 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         """
         self.mode = self.controllerConfig['mode'] if mode is None else mode
         self.wheelPort = self.wheelPortConfig[self.actor.name]
+        # holes might have changed in the config.
+        self.holeTablesCache = None
+        self.positionCache.reconcile()
+        # simulator is rebuilt on each load, so a reloaded simulator module is used after a reconnect.
+        # timing model is a preset name or dict of SimTiming parameters.
+        self.sim = simulator.FilterwheelSim(self.actor.name, timing=self.controllerConfig.get('simTiming'))
         bufferedSocket.EthComm.__init__(self,
                                         host=self.controllerConfig['host'],
                                         port=self.controllerConfig['port'],
@@ -77,6 +289,7 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         """
         self.ioBuffer = bufferedSocket.BufferedSocket(self.name + 'IO', EOL='\n', timeout=3)
         s = self.connectSock()
+        self.batchedAdc = True
 
     def _closeComm(self, cmd):
         """Close socket.
@@ -84,6 +297,7 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         :param cmd: current command.
         """
         self.closeSock()
+        self.positionCache.flush()
 
     def _testComm(self, cmd):
         """Test communication.
@@ -91,7 +305,7 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         :param cmd: current command.
         :raise: Exception if the communication has failed with the controller.
         """
-        return self.sendOneCommand('adc 1', cmd=cmd)
+        return self.readAdc(cmd)
 
     def _init(self, cmd, doLineWheel=True, doQthWheel=True, doReset=True):
         """Initialise both wheel by default
@@ -100,8 +314,17 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         :raise: Exception with warning message.
         """
         if doReset:
-            self.actor.actorData.persistKey('linewheel', -1)
-            self.actor.actorData.persistKey('qthwheel', -1)
+            self.positionCache.set('linewheel', -1)
+            self.positionCache.set('qthwheel', -1)
+
+        if doLineWheel and doQthWheel and self.controllerConfig.get('parallelInit', False):
+            try:
+                self.initWheels(cmd)
+                cmd.inform('text="line wheel and qth wheel init OK"')
+            except:
+                cmd.warn('text="parallel wheel init FAILED ! "')
+                raise
+            return
 
         if doLineWheel:
             try:
@@ -120,14 +343,14 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
                 raise
 
     def loadWheelPosition(self, wheel):
-        """load persisted wheel position and hole from instdata
+        """load wheel position and hole, from memory, see PositionCache.
 
         :param cmd: current command.
         :raise: Exception with warning message.
         """
         try:
-            position, = self.actor.actorData.loadKey(wheel)
-            holes = self.lineHoles if wheel == 'linewheel' else self.qthHoles
+            position = self.positionCache.get(wheel)
+            holes, __ = self.holeTables[wheel]
             hole = holes[position]
         except:
             # a bit of flexibility, to be removed later
@@ -136,14 +359,45 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
 
         return position, hole
 
+    def readAdc(self, cmd):
+        """Read both adc channels, in a single round trip if the server supports the batched request.
+
+        :param cmd: current command.
+        :raise: Exception with warning message.
+        """
+        with self.ioLock:
+            if self.batchedAdc:
+                ret = self.sendOneCommand('adc all', cmd=cmd)
+                try:
+                    adc1, adc2 = ret.split(',')
+                    float(adc1), float(adc2)
+                    return adc1, adc2
+                except ValueError:
+                    self.logger.warning(f'batched adc read is not supported ({ret}), reading one channel at a time')
+                    self.batchedAdc = False
+                    self.flushInput(cmd)
+
+            adc1 = self.sendOneCommand('adc 1', cmd=cmd)
+            adc2 = self.sendOneCommand('adc 2', cmd=cmd)
+
+            return adc1, adc2
+
+    def flushInput(self, cmd, timeout=0.5):
+        """Discard any pending output from the server.
+
+        :param cmd: current command.
+        :param timeout: time to wait for more output.
+        """
+        while self.getOneResponse(cmd=cmd, timeout=timeout):
+            pass
+
     def getStatus(self, cmd):
         """Get all ports status.
 
         :param cmd: current command.
         :raise: Exception with warning message.
         """
-        adc1 = self.sendOneCommand('adc 1', cmd=cmd)
-        adc2 = self.sendOneCommand('adc 2', cmd=cmd)
+        adc1, adc2 = self.readAdc(cmd)
 
         linePosition, lineHole = self.loadWheelPosition('linewheel')
         qthPosition, qthHole = self.loadWheelPosition('qthwheel')
@@ -151,6 +405,90 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         cmd.inform(f'adc={adc1},{adc2}')
         cmd.inform(f'linewheel={linePosition},{lineHole}')
         cmd.inform(f'qthwheel={qthPosition},{qthHole}')
+        self.genMoveQueueKey(cmd)
+        self.ioStats.genKeys(cmd)
+
+    def genMoveQueueKey(self, cmd):
+        """Generate move queue depth keyword, per wheel.
+
+        :param cmd: current command.
+        """
+        with self.moveQueueLock:
+            depths = [int(wheel in self.pendingMoves) for wheel in ['linewheel', 'qthwheel']]
+
+        cmd.inform(f'moveQueue={",".join(map(str, depths))}')
+
+    def requestMove(self, cmd, wheel, position, force=False):
+        """Move wheel to position, or queue the target if a move is already ongoing.
+
+        Pending targets are coalesced per wheel, only the most recent one is executed and superseded commands finish.
+        :param cmd: current command.
+        :param wheel: linewheel|qthwheel
+        :param position: int(1-5)
+        :param force: move even if the wheel is already at position.
+        :return: True if the move is done, False if it has been queued, cmd being finished once executed.
+        """
+        with self.moveQueueLock:
+            if self.moveOngoing:
+                superseded = self.pendingMoves.get(wheel)
+                self.pendingMoves[wheel] = (cmd, position, force)
+                cmd.inform(f'wheelMove={wheel},{position},queued')
+
+                if superseded is not None:
+                    supersededCmd, supersededPosition, __ = superseded
+                    supersededCmd.finish(f'wheelMove={wheel},{supersededPosition},superseded')
+
+                return False
+
+            self.moveOngoing = True
+
+        try:
+            self.executeMove(cmd, wheel, position, force=force)
+        finally:
+            with self.moveQueueLock:
+                if self.pendingMoves:
+                    self.putMsg(self.processMoveQueue)
+                else:
+                    self.moveOngoing = False
+
+        return True
+
+    def processMoveQueue(self):
+        """Execute pending moves until the queue is empty."""
+        while True:
+            with self.moveQueueLock:
+                if not self.pendingMoves:
+                    self.moveOngoing = False
+                    return
+
+                wheel = next(iter(self.pendingMoves))
+                cmd, position, force = self.pendingMoves.pop(wheel)
+
+            try:
+                self.executeMove(cmd, wheel, position, force=force)
+                self.generate(cmd)
+            except Exception as e:
+                cmd.fail(f'text="{wheel} move to {position} FAILED : {e}"')
+
+    def executeMove(self, cmd, wheel, position, force=False):
+        """Go through the MOVING state, unless the wheel is already at position.
+
+        :param cmd: current command.
+        :param wheel: linewheel|qthwheel
+        :param position: int(1-5)
+        :param force: move even if the wheel is already at position.
+        """
+        current, hole = self.loadWheelPosition(wheel)
+
+        # sequences often set the same hole again, no need to move.
+        if current == position and not force:
+            cmd.inform(f'text="{wheel} already at position {position}({hole}), use force to move anyway"')
+            return
+
+        cmd.inform(f'wheelMove={wheel},{position},moving')
+        self.substates.move(wheel=wheel, position=position, cmd=cmd)
+        state = 'done' if self.substates.current == 'IDLE' else 'failed'
+        cmd.inform(f'wheelMove={wheel},{position},{state}')
 
     def moving(self, cmd, wheel, position):
         """Move required wheel to required position
@@ -159,19 +497,20 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         :param position: int(1-5)
         :raise: Exception with warning message.
         """
-        current, __ = self.loadWheelPosition(wheel)
-        if current == -1:
-            raise UserWarning(f'{wheel} has not been initialized properly')
+        with self.ioLock:
+            current, __ = self.loadWheelPosition(wheel)
+            if current == -1:
+                raise UserWarning(f'{wheel} has not been initialized properly')
 
-        ret = self.sendOneCommand(f'{wheel} {position}', cmd=cmd)
-        cmd.inform(f'text="{ret}"')
+            ret = self.sendOneCommand(f'{wheel} {position}', cmd=cmd)
+            cmd.inform(f'text="{ret}"')
 
-        ret = self.waitForEndBlock(cmd, 'Moved to position', timeout=10, timeLim=30)
+            ret = self.waitForEndBlock(cmd, self.endBlocks['move'], timeout=10, timeLim=30)
 
-        __, position = ret.split('Moved to position')
-        position = int(position)
+            __, position = ret.split('Moved to position')
+            position = int(position)
 
-        self.actor.actorData.persistKey(wheel, position)
+            self.positionCache.set(wheel, position)
 
     def initWheel(self, cmd, wheel):
         """Init required wheel
@@ -180,58 +519,198 @@ class filterwheel(FSMThread, bufferedSocket.EthComm):
         :param position: int(1-5)
         :raise: Exception with warning message.
         """
-        cmd.inform(f'text="initializing {wheel}..."')
+        with self.ioLock:
+            calibrate = self.endBlocks['calibrate']
+            cmd.inform(f'text="initializing {wheel}..."')
 
-        ret = self.sendOneCommand(f'{wheel} {-1}', cmd=cmd)
-        cmd.inform(f'text="{ret}"')
-        # declaring which wheel is going to be calibrated.
-        self.waitForEndBlock(cmd, f'Calibrating FW {self.wheelPort[wheel]}', timeout=30, timeLim=60)
-        # wait for the start the calibration
-        self.waitForEndBlock(cmd, f'Calibrating')
-        # wait for DONE or CALIBRATE FAILED basically.
-        try:
-            self.waitForEndBlock(cmd, 'Done', timeout=10, timeLim=30)
-        except TimeoutError:
-            raise RuntimeError(f'{wheel} CALIBRATION FAILED !')
+            ret = self.sendOneCommand(f'{wheel} {-1}', cmd=cmd)
+            cmd.inform(f'text="{ret}"')
 
-        self.actor.actorData.persistKey(wheel, 1)
+            try:
+                # declaring which wheel is going to be calibrated.
+                self.waitForEndBlock(cmd, calibrate.expecting(f'Calibrating FW {self.wheelPort[wheel]}'),
+                                     timeout=30, timeLim=60)
+                # wait for the start the calibration
+                self.waitForEndBlock(cmd, calibrate.expecting('Calibrating'))
+                # wait for DONE or CALIBRATE FAILED basically.
+                try:
+                    self.waitForEndBlock(cmd, calibrate, timeout=10, timeLim=30)
+                except TimeoutError:
+                    raise RuntimeError(f'{wheel} CALIBRATION FAILED !')
+
+            except EndBlockFailed:
+                raise RuntimeError(f'{wheel} CALIBRATION FAILED !')
+
+            self.positionCache.set(wheel, 1)
+
+    def initWheels(self, cmd, timeLim=90):
+        """Calibrate both wheels concurrently.
+
+        The server has to tag every output line with the originating wheel ("linewheel| ..."), see tcp_server.readme,
+        an untagged line cannot be attributed to a wheel so initialization fails on the first one.
+        :param cmd: current command.
+        :param timeLim: total timeout.
+        :raise: Exception with warning message.
+        """
+        with self.ioLock:
+            calibrate = self.endBlocks['calibrate']
+            # remaining phases per wheel, as in initWheel.
+            phases = dict([(wheel, [calibrate.expecting(f'Calibrating FW {port}'),
+                                    calibrate.expecting('Calibrating'),
+                                    calibrate]) for wheel, port in self.wheelPort.items()])
+            failed = []
+
+            def demux(line):
+                """Return wheel and text for a given server line."""
+                tag, sep, text = line.partition('|')
+                if not sep or tag.strip() not in phases:
+                    raise RuntimeError(f'untagged output from calibrate all: "{line}", '
+                                       f'server does not support parallel init, unset parallelInit')
+
+                return tag.strip(), text.strip()
+
+            def process(line):
+                """Advance wheel calibration phases, return True when all wheels are done."""
+                cmd.inform(f'text="{line}"')
+                if not line:
+                    return not any(phases.values())
+
+                wheel, text = demux(line)
+
+                if not phases[wheel]:
+                    return not any(phases.values())
+
+                try:
+                    if phases[wheel][0].match(text):
+                        phases[wheel].pop(0)
+                        if not phases[wheel]:
+                            self.positionCache.set(wheel, 1)
+                            cmd.inform(f'text="{wheel} init OK"')
+                except EndBlockFailed:
+                    failed.append(wheel)
+                    phases[wheel] = []
+
+                return not any(phases.values())
+
+            cmd.inform('text="initializing linewheel and qthwheel in parallel..."')
+            ret = self.sendOneCommand('calibrate all', cmd=cmd)
+
+            try:
+                if not process(ret):
+                    for line in self.readLines(cmd, timeout=30, timeLim=timeLim):
+                        if process(line):
+                            break
+            except TimeoutError:
+                failed.extend([wheel for wheel, remaining in phases.items() if remaining])
+            except RuntimeError:
+                # the server is still calibrating, reconnecting so its output is not read by the next request.
+                self._closeComm(cmd)
+                self._openComm(cmd)
+                raise
+
+            if failed:
+                raise RuntimeError(f'{",".join(failed)} CALIBRATION FAILED !')
 
     def adcCalib(self, cmd):
         """zeros adc channels.
         :param cmd: current command.
         :raise: Exception with warning message.
         """
-        ret = self.sendOneCommand('adccalib ', cmd=cmd)
-        cmd.inform(f'text="{ret}"')
+        with self.ioLock:
+            ret = self.sendOneCommand('adccalib ', cmd=cmd)
+            cmd.inform(f'text="{ret}"')
 
-        ret = self.sendOneCommand('continue ', cmd=cmd)
-        cmd.inform(f'text="{ret}"')
+            ret = self.sendOneCommand('continue ', cmd=cmd)
+            cmd.inform(f'text="{ret}"')
 
-        self.waitForEndBlock(cmd, 'Zeros for channel', timeout=5, timeLim=15)
+            self.waitForEndBlock(cmd, self.endBlocks['adccalib'], timeout=5, timeLim=15)
 
-    def waitForEndBlock(self, cmd, endBlock, timeout=10, timeLim=30, maxIter=100):
-        """Wait until end block is returned, various check are made to avoid endless loop.
+    def readLines(self, cmd, timeout=10, timeLim=30, maxEmpty=20):
+        """Yield non-empty lines from the controller until timeLim, with a single deadline for the whole block.
         :param cmd: current command.
-        :param endBlock: expected end block
-        :param timeout: buffer timeout.
+        :param timeout: maximum time waiting for a single line.
         :param timeLim: total timeout.
-        :raise: Exception with warning message.
+        :param maxEmpty: maximum number of consecutive empty lines returned before their timeout.
+        :raise: TimeoutError if timeLim is reached.
         """
-        ret = ''
-        start = time.time()
-        iter = 0
+        deadline = time.monotonic() + timeLim
+        nEmpty = 0
 
-        while endBlock not in ret:
-            ret = self.getOneResponse(cmd=cmd, timeout=timeout)
-            if ret:
-                cmd.inform(f'text="{ret}"')
-            if (time.time() - start) > timeLim:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 raise TimeoutError('filterwheel-dcb has not answered in the appropriate timing...')
-            if iter > maxIter:
-                raise RuntimeError('socket is broken...')
-            iter += 1
 
-        return ret
+            readTimeout = min(timeout, remaining)
+            start = time.monotonic()
+            ret = self.getOneResponse(cmd=cmd, timeout=readTimeout)
+
+            if not ret:
+                # a timed out read lasts the whole timeout, a closed connection returns straight away.
+                nEmpty = nEmpty + 1 if (time.monotonic() - start) < readTimeout else 0
+                if nEmpty > maxEmpty:
+                    raise RuntimeError('socket is broken...')
+                continue
+
+            nEmpty = 0
+            yield ret
+
+    def waitForEndBlock(self, cmd, endBlock, timeout=10, timeLim=30, maxEmpty=20):
+        """Wait until one of the end blocks is returned, with a single deadline for the whole block.
+        :param cmd: current command.
+        :param endBlock: EndBlock matcher, or expected end block string(s).
+        :param timeout: maximum time waiting for a single line.
+        :param timeLim: total timeout.
+        :param maxEmpty: maximum number of consecutive empty lines returned before their timeout.
+        :return: the line which matched.
+        :raise: EndBlockFailed if a failure pattern is matched, TimeoutError if timeLim is reached.
+        """
+        matcher = endBlock if isinstance(endBlock, EndBlock) else EndBlock.literal(endBlock)
+        start = time.monotonic()
+        timedOut = False
+
+        try:
+            for ret in self.readLines(cmd, timeout=timeout, timeLim=timeLim, maxEmpty=maxEmpty):
+                cmd.inform(f'text="{ret}"')
+
+                if matcher.match(ret):
+                    return ret
+
+        except TimeoutError:
+            timedOut = True
+            raise
+
+        finally:
+            self.ioStats.record('waitForEndBlock', time.monotonic() - start, timeout=timedOut)
+
+    def isTimeout(self, reply, elapsed, timeout=None):
+        """Whether a reply timed out, an empty reply only counts if it took the whole timeout since the controller also
+        sends blank lines.
+
+        :param reply: reply returned by the socket.
+        :param elapsed: time spent waiting for it.
+        :param timeout: timeout of the read, the socket buffer default if None.
+        """
+        timeout = self.ioBuffer.timeout if timeout is None else timeout
+        return not reply and elapsed >= timeout
+
+    def sendOneCommand(self, cmdStr, doClose=False, cmd=None):
+        """Send one command and return one response, accumulating i/o statistics."""
+        start = time.monotonic()
+        reply = bufferedSocket.EthComm.sendOneCommand(self, cmdStr, doClose=doClose, cmd=cmd)
+        elapsed = time.monotonic() - start
+        self.ioStats.record('sendOneCommand', elapsed, nBytes=len(cmdStr) + len(reply),
+                            timeout=self.isTimeout(reply, elapsed))
+        return reply
+
+    def getOneResponse(self, sock=None, timeout=None, cmd=None):
+        """Return one response, accumulating i/o statistics."""
+        start = time.monotonic()
+        reply = bufferedSocket.EthComm.getOneResponse(self, sock=sock, timeout=timeout, cmd=cmd)
+        elapsed = time.monotonic() - start
+        self.ioStats.record('getOneResponse', elapsed, nBytes=len(reply),
+                            timeout=self.isTimeout(reply, elapsed, timeout=timeout))
+        return reply
 
     def createSock(self):
         """Create socket in operation, simulator otherwise.
@@ -1,23 +1,226 @@
 __author__ = 'alefur'
 
+import random
 import socket
 import time
+from collections import deque
 
 
-class FilterwheelSim(socket.socket):
+class SimTiming(object):
+    """Timing model of the filterwheel simulator, durations are in seconds."""
+    presets = dict(fast=dict(),
+                   legacy=dict(connect=0.2, io=0.02),
+                   realistic=dict(connect=0.2, io=0.002, adc=0.1, moveOverhead=0.5, moveSlot=1.2, calibration=15,
+                                  adcCalib=5, jitter=0.05))
+
+    def __init__(self, connect=0, io=0, adc=0, moveOverhead=0, moveSlot=0, calibration=0, adcCalib=0, jitter=0,
+                 moveFailureRate=0, calibFailureRate=0, seed=None):
+        """
+        :param connect: connection time.
+        :param io: time spent in each sendall/recv call.
+        :param adc: adc read time.
+        :param moveOverhead: fixed time per move.
+        :param moveSlot: time per slot travelled.
+        :param calibration: wheel calibration time.
+        :param adcCalib: adc zeroing time.
+        :param jitter: relative jitter applied to every duration.
+        :param moveFailureRate: probability for a move to fail.
+        :param calibFailureRate: probability for a calibration to fail.
+        :param seed: random seed, for reproducible jitter and failures.
+        """
+        self.connect = connect
+        self.io = io
+        self.adc = adc
+        self.moveOverhead = moveOverhead
+        self.moveSlot = moveSlot
+        self.calibration = calibration
+        self.adcCalib = adcCalib
+        self.jitter = jitter
+        self.moveFailureRate = moveFailureRate
+        self.calibFailureRate = calibFailureRate
+        self.random = random.Random(seed)
+
+    @classmethod
+    def fromConfig(cls, config=None):
+        """Timing model from a preset name, or a dict of parameters overriding an optional preset (fast by default).
+
+        :param config: None(legacy)|fast|legacy|realistic or dict.
+        """
+        if config is None:
+            config = 'legacy'
+
+        if isinstance(config, str):
+            return cls(**cls.presets[config])
+
+        config = dict(config)
+        preset = config.pop('preset', 'fast')
+        return cls(**{**cls.presets[preset], **config})
+
+    def duration(self, nominal):
+        """Apply jitter to nominal duration."""
+        if not nominal:
+            return 0
+
+        return max(0, nominal * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def moveDuration(self, start, end, nSlots=5):
+        """Time to travel from start to end position, the wheel taking the shortest way."""
+        nTravel = abs(end - start) % nSlots
+        nTravel = min(nTravel, nSlots - nTravel)
+        return self.duration(self.moveOverhead + nTravel * self.moveSlot)
+
+    def fails(self, rate):
+        """Draw a failure given its probability."""
+        return rate > 0 and self.random.random() < rate
+
+
+class FilterwheelModel(object):
+    """Response model of the filterwheel host tcp server, shared by the simulator and the loopback server."""
     wheelPortConfig = dict(dcb=dict(line=1, qth=0),
                            dcb2=dict(line=0, qth=1))
 
-    def __init__(self, name):
-        """Fake filterwheel tcp server."""
-        socket.socket.__init__(self, socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, name, timing=None):
+        """
+        :param name: actor name.
+        :param timing: SimTiming or config given to SimTiming.fromConfig.
+        """
         self.wheelPort = self.wheelPortConfig[name]
-        self.buf = []
+        self.timing = timing if isinstance(timing, SimTiming) else SimTiming.fromConfig(timing)
+        self.positions = dict(line=1, qth=1)
+
+    def respond(self, cmdStr):
+        """Return the responses to a request, with the delay preceding each response."""
+        if cmdStr == 'adc all':
+            return [(2 * self.timing.duration(self.timing.adc), '-.0014,-.0014\n')]
+
+        elif 'adc ' in cmdStr:
+            return [(self.timing.duration(self.timing.adc), '-.0014\n')]
+
+        elif cmdStr == 'calibrate all':
+            return self.mergeSteps(linewheel=self.wheelCalib('line'), qthwheel=self.wheelCalib('qth'))
+
+        elif 'linewheel' in cmdStr:
+            __, position = cmdStr.split('linewheel')
+            return self.wheelCommand('line', int(position))
+
+        elif 'qthwheel' in cmdStr:
+            __, position = cmdStr.split('qthwheel')
+            return self.wheelCommand('qth', int(position))
+
+        elif 'adccalib' in cmdStr:
+            return [(0, 'Turn off all lamps so that the integrating sphere is dark.\n'),
+                    (0, 'When this is done, hit any key to continue\n')]
+
+        elif 'continue' in cmdStr:
+            iterDelay = self.timing.duration(self.timing.adcCalib) / 5
+            return [(iterDelay, 'iteration 1 z1=0.0491  z2=0.0486 \n'),
+                    (iterDelay, 'iteration 2 z1=0.0491  z2=0.0488 \n'),
+                    (iterDelay, 'iteration 3 z1=0.0491  z2=0.0486 \n'),
+                    (iterDelay, 'iteration 4 z1=0.0491  z2=0.0486 \n'),
+                    (iterDelay, 'iteration 5 z1=0.0491  z2=0.0486 \n'
+                                '\nZeros for channel 1, 2 = .0491, .0486\n')]
+
+        return []
+
+    @staticmethod
+    def mergeSteps(**stepsPerWheel):
+        """Interleave wheels output as the server would do, each wheel running on its own clock.
+
+        Lines are tagged with their wheel ("linewheel| ...") and sorted by due time, delays are then made relative to
+        the previous line again.
+        """
+        timeline = []
+
+        for wheel, steps in stepsPerWheel.items():
+            due = 0
+            for delay, line in steps:
+                due += delay
+                timeline.append((due, f'{wheel}| {line}'))
+
+        merged = []
+        previous = 0
+        for due, line in sorted(timeline, key=lambda step: step[0]):
+            merged.append((due - previous, line))
+            previous = due
+
+        return merged
+
+    def wheelCommand(self, wheel, position):
+        """Calibrate wheel if position==-1, move it otherwise."""
+        if position == -1:
+            return self.wheelCalib(wheel)
+
+        return self.wheelMove(wheel, position)
+
+    def wheelCalib(self, wheel):
+        """Calibration output, line by line with the delay preceding each line."""
+        wheelId = self.wheelPort[wheel]
+        success = not self.timing.fails(self.timing.calibFailureRate)
+        if success:
+            self.positions[wheel] = 1
+
+        lines = ['port0 = |UL|  port1 = |LL| \n', f'Calibrating FW {wheelId} \n', 'attached 2 filter wheel(s): \n',
+                 'index 0: ID 0 Name EFW \n', 'index 1: ID 1 Name EFW \n', 'selecting 1\n', 'Calibrating \n']
+        steps = [(0, line) for line in lines]
+        steps.append((self.timing.duration(self.timing.calibration), 'Done\n' if success else 'CALIBRATE FAILED\n'))
+        return steps
+
+    def wheelMove(self, wheel, position):
+        """Move output, with the delay preceding each response."""
+        wheelId = self.wheelPort[wheel]
+        current = self.positions[wheel]
+        duration = self.timing.moveDuration(current, position)
+
+        if self.timing.fails(self.timing.moveFailureRate):
+            end = 'MOVE FAILED\n'
+        else:
+            end = f'Moved to position {position}\n'
+            self.positions[wheel] = position
+
+        return [(0, 'port0 = UL  port1 = LL\n'),
+                (0, f'Setting FW {wheelId} to position {position}\nattached 2 filter wheel(s):\n'
+                    'index 0: ID 0 Name EFW \nindex 1: ID 1 Name EFW \n'
+                    f'selecting {wheelId} \n5 slots: 1 2 3 4 5 \ncurrent position: {current}\nMoving...\n'),
+                (duration, end)]
+
+
+class FilterwheelSim(FilterwheelModel, socket.socket):
+
+    def __init__(self, name, timing=None, segmentSize=None):
+        """Fake filterwheel tcp server.
+
+        :param name: actor name.
+        :param timing: SimTiming or config given to SimTiming.fromConfig.
+        :param segmentSize: if set, responses are split in segments of that size, fragmenting lines.
+        """
+        socket.socket.__init__(self, socket.AF_INET, socket.SOCK_STREAM)
+        FilterwheelModel.__init__(self, name, timing=timing)
+        self.segmentSize = segmentSize
+        # byte stream as (due, memoryview) segments, the head segment being consumed from headOffset.
+        self.buf = deque()
+        self.headOffset = 0
+        self.lastDue = 0
+
+    @staticmethod
+    def sleep(duration):
+        if duration > 0:
+            time.sleep(duration)
+
+    def schedule(self, response, delay=0):
+        """Append response to buffer, available delay seconds after the previous response."""
+        due = max(time.monotonic(), self.lastDue) + delay
+        data = memoryview(response.encode())
+        segmentSize = len(data) if not self.segmentSize else self.segmentSize
+
+        for start in range(0, len(data), segmentSize):
+            self.buf.append((due, data[start:start + segmentSize]))
+
+        self.lastDue = due
 
     def connect(self, server):
         """Fake the connection to tcp server."""
         (ip, port) = server
-        time.sleep(0.2)
+        self.sleep(self.timing.connect)
         if type(ip) is not str:
             raise TypeError
         if type(port) is not int:
@@ -25,60 +228,41 @@ class FilterwheelSim(socket.socket):
 
     def sendall(self, cmdStr, flags=None):
         """Send fake packets, append fake response to buffer."""
-        time.sleep(0.02)
+        self.sleep(self.timing.io)
         cmdStr = cmdStr.decode()
         cmdStr, __ = cmdStr.split('\r\n')
 
-        if 'adc ' in cmdStr:
-            self.buf.append('-.0014\n')
-
-        elif 'linewheel' in cmdStr:
-            __, position = cmdStr.split('linewheel')
-            position = int(position)
-            if position == -1:
-                self.buf.append(self.wheelCalib('line'))
-            else:
-                self.buf.append('port0 = UL  port1 = LL\n')
-                self.buf.append('Setting FW 0 to position 1\nattached 2 filter wheel(s):\nindex 0: ID 0 Name EFW \n'
-                                'index 1: ID 1 Name EFW \nselecting 0 \n5 slots: 1 2 3 4 5 \ncurrent position: 1\n'
-                                f'Moving...\nMoved to position {position}\n')
+        for delay, response in self.respond(cmdStr):
+            self.schedule(response, delay=delay)
 
-        elif 'qthwheel' in cmdStr:
-            __, position = cmdStr.split('qthwheel')
-            position = int(position)
+    def recv(self, buffersize, flags=None):
+        """Return and consume up to buffersize bytes from the stream, waiting for the next response to be due.
 
-            if position == -1:
-                self.buf.append(self.wheelCalib('qth'))
-            else:
-                self.buf.append('port0 = UL  port1 = LL\n')
-                self.buf.append('Setting FW 0 to position 1\nattached 2 filter wheel(s):\nindex 0: ID 0 Name EFW \n'
-                                'index 1: ID 1 Name EFW \nselecting 0 \n5 slots: 1 2 3 4 5 \ncurrent position: 1\n'
-                                f'Moving...\nMoved to position {position}\n')
+        An empty buffer returns b'', as a closed connection would do.
+        """
+        self.sleep(self.timing.io)
+        if not self.buf:
+            return b''
 
-        elif 'adccalib' in cmdStr:
-            self.buf.append('Turn off all lamps so that the integrating sphere is dark.\n')
-            self.buf.append('When this is done, hit any key to continue\n')
+        self.sleep(self.buf[0][0] - time.monotonic())
+        now = time.monotonic()
+        chunks = []
+        size = 0
 
-        elif 'continue' in cmdStr:
-            self.buf.append('iteration 1 z1=0.0491  z2=0.0486 \n')
-            self.buf.append('iteration 2 z1=0.0491  z2=0.0488 \n'
-                            'iteration 3 z1=0.0491  z2=0.0486 \n'
-                            'iteration 4 z1=0.0491  z2=0.0486 \n'
-                            'iteration 5 z1=0.0491  z2=0.0486 \n'
-                            '\nZeros for channel 1, 2 = .0491, .0486\n')
+        while self.buf and size < buffersize and (not chunks or self.buf[0][0] <= now):
+            due, segment = self.buf[0]
+            segment = segment[self.headOffset:]
+            nBytes = min(len(segment), buffersize - size)
+            chunks.append(segment[:nBytes])
+            size += nBytes
 
-    def wheelCalib(self, wheel):
-        wheelId = self.wheelPort[wheel]
-        wheelCalib = f'port0 = |UL|  port1 = |LL| \nCalibrating FW {wheelId} \nattached 2 filter wheel(s): \n' \
-                     'index 0: ID 0 Name EFW \nindex 1: ID 1 Name EFW \nselecting 1\nCalibrating \nDone\n'
-        return wheelCalib
+            if nBytes == len(segment):
+                self.buf.popleft()
+                self.headOffset = 0
+            else:
+                self.headOffset += nBytes
 
-    def recv(self, buffersize, flags=None):
-        """Return and remove fake response from buffer."""
-        time.sleep(0.02)
-        ret = self.buf[0]
-        self.buf = self.buf[1:]
-        return str(ret).encode()
+        return b''.join(chunks)
 
     def close(self):
         pass
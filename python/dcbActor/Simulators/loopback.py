@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the filterwheel host tcp server, answering from the simulator response model.
+
+Run it, then point the filterwheel config to it (host=localhost, port=9000) and start the controller in operation
+mode, so the real EthComm/BufferedSocket path is exercised without the hardware:
+
+    python -m dcbActor.Simulators.loopback --name dcb --port 9000 --timing realistic
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+
+from dcbActor.Simulators.filterwheel import FilterwheelModel
+
+
+class LoopbackServer(object):
+    """Asyncio tcp server speaking the filterwheel host protocol, requests are served one at a time."""
+
+    def __init__(self, name, host='localhost', port=9000, timing=None):
+        """
+        :param name: actor name.
+        :param host: interface to listen on.
+        :param port: port to listen on.
+        :param timing: SimTiming or config given to SimTiming.fromConfig.
+        """
+        self.host = host
+        self.port = port
+        self.model = FilterwheelModel(name, timing=timing)
+        self.hardwareLock = asyncio.Lock()
+        self.server = None
+
+    async def handleClient(self, reader, writer):
+        try:
+            while True:
+                recv = await reader.readline()
+                if not recv:
+                    break
+
+                cmdStr = recv.decode().strip()
+                if not cmdStr:
+                    continue
+
+                async with self.hardwareLock:
+                    for delay, response in self.model.respond(cmdStr):
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+
+                        writer.write(response.encode())
+                        await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Start listening, return the bound port (useful with port=0)."""
+        self.server = await asyncio.start_server(self.handleClient, self.host, self.port, reuse_address=True)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def serve(self):
+        port = await self.start()
+        print(f'filterwheel loopback server is listening on {self.host}:{port}')
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await stop.wait()
+        await self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default='dcb', type=str, help='actor name, sets the wheel ports')
+    parser.add_argument('--host', default='localhost', type=str, help='interface to listen on')
+    parser.add_argument('--port', default=9000, type=int, help='port to listen on')
+    parser.add_argument('--timing', default='realistic', type=str,
+                        help='timing preset (fast|legacy|realistic) or json dict of SimTiming parameters')
+    args = parser.parse_args()
+
+    timing = json.loads(args.timing) if args.timing.startswith('{') else args.timing
+    asyncio.run(LoopbackServer(args.name, host=args.host, port=args.port, timing=timing).serve())
+
+
+if __name__ == '__main__':
+    main()
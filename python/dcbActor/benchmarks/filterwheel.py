@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Filterwheel controller benchmark, driving getStatus, moving, initWheel and adcCalib through the simulator and/or the
+loopback stand-in server, and writing per-operation latency distributions, round-trip counts and the controller i/o
+statistics as json.
+
+    python -m dcbActor.benchmarks.filterwheel --target sim loopback --timing fast --repeat 50 --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+
+from dcbActor.Controllers.filterwheel import filterwheel
+from dcbActor.Simulators.loopback import LoopbackServer
+
+
+class BenchData(object):
+    """In-memory stand-in for instdata persistence."""
+
+    def __init__(self):
+        self.keys = dict()
+
+    def loadKey(self, keyName, actorName=None):
+        return self.keys[keyName]
+
+    def persistKey(self, keyName, *values):
+        self.keys[keyName] = values
+
+
+class BenchCmd(object):
+    """Command stand-in, only counting the generated replies."""
+
+    def __init__(self):
+        self.nReplies = 0
+
+    def reply(self, *args, **kwargs):
+        self.nReplies += 1
+
+    inform = warn = diag = finish = fail = reply
+
+
+class BenchActor(object):
+    """Minimal actor for the filterwheel controller."""
+
+    def __init__(self, name, controllerConfig):
+        self.name = name
+        self.actorConfig = dict(filterwheel=controllerConfig)
+        self.actorData = BenchData()
+        self.bcast = BenchCmd()
+
+
+class BenchFilterwheel(filterwheel):
+    """Filterwheel controller counting the requests sent to the server."""
+
+    def __init__(self, *args, **kwargs):
+        filterwheel.__init__(self, *args, **kwargs)
+        self.nRoundTrips = 0
+
+    def sendOneCommand(self, cmdStr, doClose=False, cmd=None):
+        self.nRoundTrips += 1
+        return filterwheel.sendOneCommand(self, cmdStr, doClose=doClose, cmd=cmd)
+
+
+class LoopbackThread(object):
+    """Loopback server running its own event loop in a background thread, on a free port."""
+
+    def __init__(self, name, timing):
+        self.loop = asyncio.new_event_loop()
+        self.server = LoopbackServer(name, host='localhost', port=0, timing=timing)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.port = None
+
+    def start(self):
+        self.thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def summarize(latencies, nRoundTrips):
+    """Latency distribution (ms) and round trips per call."""
+    latencies = sorted(latencies)
+    nCalls = len(latencies)
+
+    return dict(nCalls=nCalls,
+                roundTripsPerCall=nRoundTrips / nCalls,
+                latencyMs=dict(mean=1000 * sum(latencies) / nCalls,
+                               min=1000 * latencies[0],
+                               median=1000 * percentile(latencies, 0.5),
+                               p90=1000 * percentile(latencies, 0.9),
+                               p99=1000 * percentile(latencies, 0.99),
+                               max=1000 * latencies[-1]))
+
+
+def timeOperation(controller, func, repeat):
+    """Call func repeat times, return latency distribution and round trip count."""
+    latencies = []
+    nRoundTrips = controller.nRoundTrips
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+
+    return summarize(latencies, controller.nRoundTrips - nRoundTrips)
+
+
+def runBenchmark(target, timing='fast', repeat=20, name='dcb'):
+    """Drive the filterwheel controller through every operation.
+
+    :param target: sim|loopback.
+    :param timing: SimTiming config, see SimTiming.fromConfig.
+    :param repeat: number of calls per operation.
+    :param name: actor name.
+    :return: report as a dict.
+    """
+    loopback = None
+    config = dict(mode='simulation', host='localhost', port=9000, simTiming=timing,
+                  lineHoles=['none', '1.0', '2.0', '3.0', '4.0'], qthHoles=['none', 'a', 'b', 'c', 'd'])
+
+    if target == 'loopback':
+        loopback = LoopbackThread(name, timing)
+        loopback.start()
+        config.update(mode='operation', port=loopback.port)
+    elif target != 'sim':
+        raise ValueError(f'unknown target:{target}, valids:sim,loopback')
+
+    actor = BenchActor(name, config)
+    controller = BenchFilterwheel(actor, 'filterwheel', loglevel=logging.WARNING)
+    cmd = BenchCmd()
+
+    try:
+        controller._loadCfg(cmd)
+        controller._openComm(cmd)
+        controller._testComm(cmd)
+
+        operations = dict()
+        operations['initWheel'] = timeOperation(controller, lambda i: controller.initWheel(cmd, 'linewheel'), repeat)
+        operations['getStatus'] = timeOperation(controller, lambda i: controller.getStatus(cmd), repeat)
+        operations['moving'] = timeOperation(controller, lambda i: controller.moving(cmd, 'linewheel', i % 4 + 2),
+                                             repeat)
+        operations['adcCalib'] = timeOperation(controller, lambda i: controller.adcCalib(cmd), repeat)
+
+    finally:
+        controller._closeComm(cmd)
+        if loopback is not None:
+            loopback.stop()
+
+    return dict(target=target, timing=timing, repeat=repeat, name=name, operations=operations,
+                ioStats=controller.ioStats.report())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', default=['sim', 'loopback'], nargs='+', choices=['sim', 'loopback'],
+                        help='controller backend(s) to benchmark')
+    parser.add_argument('--timing', default='fast', type=str,
+                        help='timing preset (fast|legacy|realistic) or json dict of SimTiming parameters')
+    parser.add_argument('--repeat', default=20, type=int, help='number of calls per operation')
+    parser.add_argument('--name', default='dcb', type=str, help='actor name, sets the wheel ports')
+    parser.add_argument('--output', default=None, type=str, help='json report file, stdout if not given')
+    args = parser.parse_args()
+
+    timing = json.loads(args.timing) if args.timing.startswith('{') else args.timing
+    reports = [runBenchmark(target, timing=timing, repeat=args.repeat, name=args.name) for target in args.target]
+
+    if args.output is None:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,30 @@
 #!/usr/bin/env python
 
 import argparse
+import importlib
 import logging
-from importlib import reload
+import threading
+import time
 
 import dcbActor.utils.dcbConfig as dcbConfig
 import ics.utils.fsm.fsmActor as fsmActor
 
-reload(dcbConfig)
-
 
 class DcbActor(fsmActor.FsmActor):
     knownControllers = ['lamps', 'filterwheel']
     # we start everything by default
     startingControllers = knownControllers
+    # modules which are only reloaded on hotReload, so the actor starts without reloading anything.
+    hotReloadModules = ['dcbActor.utils.makeLamDesign', 'dcbActor.utils.dcbConfig', 'dcbActor.Simulators.filterwheel',
+                        'ics.utils.sps.lamps.commands.LampsCmd']
+    # default time (s) given to each controller to connect at startup, overridden by controller connectTimeout config.
+    connectTimeout = 60
 
     def __init__(self, name, productName=None, configFile=None, logLevel=logging.INFO):
         # This sets up the connections to/from the hub, the logger, and the twisted reactor.
         #
+        self.startTime = time.time()
+        self.startupTime = None
         self.dcbConfig = None
         fsmActor.FsmActor.__init__(self, name,
                                    productName=productName,
@@ -25,18 +32,65 @@ class DcbActor(fsmActor.FsmActor):
                                    logLevel=logLevel)
 
     def letsGetReadyToRumble(self):
-        """Just startup nicely."""
+        """Just startup nicely, controllers are connected concurrently."""
 
         toStart = list(set(DcbActor.startingControllers) - set(self.ignoreControllers))
+        report = dict()
+        threads = dict()
+        start = time.time()
 
         for controller in toStart:
+            threads[controller] = threading.Thread(target=self.connectController, args=(controller, report),
+                                                   name=f'connect-{controller}', daemon=True)
+            threads[controller].start()
+
+        for controller, thread in threads.items():
+            timeout = self.actorConfig.get(controller, {}).get('connectTimeout', DcbActor.connectTimeout)
+            thread.join(max(0, start + timeout - time.time()))
+
+            # still connecting, the thread is left running but startup does not wait any longer.
+            if thread.is_alive():
+                self.logger.warning(f'{controller} did not connect within {timeout}s')
+                state, duration = 'TIMEOUT', timeout
+            else:
+                state, duration = report[controller]
+
+            self.bcast.inform(f'controllerStartup={controller},{state},{duration:0.3f}')
+
+        self.startupTime = time.time() - self.startTime
+        self.logger.info(f'dcb actor started in {self.startupTime:0.3f}s')
+
+    def connectController(self, controller, report):
+        """Connect controller, reporting its state and connection time."""
+        start = time.time()
+
+        try:
             self.connect(controller)
+            state = 'OK'
+        except Exception as e:
+            self.logger.warning(f'failed to connect {controller}: {e}')
+            state = 'FAILED'
+
+        report[controller] = state, time.time() - start
 
     def reloadConfiguration(self, cmd):
         """Reload dcb configuration and keywords."""
         self.dcbConfig = dcbConfig.DcbConfig(self)
         self.dcbConfig.genKeys(cmd)
 
+    def hotReload(self, cmd):
+        """Reload dcb modules, command sets and configuration.
+
+        The filterwheel controller only uses the reloaded simulator once it is reconnected (disconnect/connect), which
+        reloads its configuration and rebuilds the simulator.
+        """
+        for moduleName in DcbActor.hotReloadModules:
+            importlib.reload(importlib.import_module(moduleName))
+            cmd.inform(f'text="reloaded {moduleName}"')
+
+        self.attachAllCmdSets()
+        self.reloadConfiguration(cmd)
+
     def attachController(self, name, instanceName=None, **kwargs):
         """Regular ICC attach controller with a gotcha for lamps."""
 
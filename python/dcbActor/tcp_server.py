@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import os
+import shlex
 import signal
 import socket
 import subprocess
 import sys
 from functools import partial
 
+# requests answered with a single line of comma-separated values, one per script.
+batched_requests = {'adc all': ['adc 1', 'adc 2']}
+# requests whose scripts are executed concurrently, each output line is tagged with the script name ("linewheel| ...").
+parallel_requests = {'calibrate all': ['linewheel -1', 'qthwheel -1']}
+
 
 def execute_script(script_name):
     process = subprocess.Popen(f"{script_name}", shell=True, stdout=subprocess.PIPE, text=True)
@@ -13,6 +22,262 @@ def execute_script(script_name):
         yield line
 
 
+def last_value(lines):
+    """Return the last non-empty line of a script output."""
+    lines = [line.strip() for line in lines if line.strip()]
+    return lines[-1] if lines else 'nan'
+
+
+def tag_line(script_name, line):
+    """Tag output line with the name of the script which produced it."""
+    return f"{script_name.split()[0]}| {line.rstrip()}\n"
+
+
+def execute_request(script_name):
+    """Execute request, expanding batched and parallel requests."""
+    if script_name in parallel_requests:
+        # no concurrency in serial mode, but the output is tagged the same way.
+        for script in parallel_requests[script_name]:
+            for line in execute_script(script):
+                yield tag_line(script, line)
+        return
+
+    if script_name not in batched_requests:
+        yield from execute_script(script_name)
+        return
+
+    values = [last_value(execute_script(script)) for script in batched_requests[script_name]]
+    yield f"{','.join(values)}\n"
+
+
+class ScriptWorker:
+    """Long-lived shell executing the wheel/adc scripts one after the other.
+
+    Spawning a new process for each request is replaced by a single /bin/sh which is fed one script per request, the
+    end of each script output being detected with a sentinel line. The request is parsed with shlex and fed back
+    quoted, so the shell never waits for the rest of an incomplete command, and a script running longer than timeout
+    is killed along with the shell, which is restarted on the next request.
+    """
+    sentinel = '__tcp_server_eos__'
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self.process = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        # own process group, so a hung script can be killed along with the shell.
+        self.process = await asyncio.create_subprocess_exec('/bin/sh',
+                                                            stdin=asyncio.subprocess.PIPE,
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            start_new_session=True)
+
+    async def kill(self):
+        """Kill the shell and whatever script it is running, it will be restarted on the next request."""
+        if self.alive:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            await self.process.wait()
+        self.process = None
+
+    async def run(self, script_name):
+        """Execute script in the worker shell and stream its output line by line."""
+        try:
+            argv = shlex.split(script_name)
+        except ValueError as e:
+            yield f"error: cannot parse {script_name!r}: {e}\n"
+            return
+
+        if not self.alive:
+            await self.start()
+
+        # stdin is detached so a script waiting for a key does not swallow the next request.
+        self.process.stdin.write(f"{shlex.join(argv)} < /dev/null\necho {self.sentinel}\n".encode())
+        await self.process.stdin.drain()
+        deadline = asyncio.get_running_loop().time() + self.timeout
+
+        while True:
+            try:
+                time_left = deadline - asyncio.get_running_loop().time()
+                line = await asyncio.wait_for(self.process.stdout.readline(), max(0, time_left))
+            except asyncio.TimeoutError:
+                await self.kill()
+                yield f"error: {script_name} has not finished within {self.timeout}s\n"
+                break
+
+            # shell has died, it will be restarted on the next request.
+            if not line:
+                self.process = None
+                break
+
+            line = line.decode()
+            if line.endswith(f"{self.sentinel}\n"):
+                # script output was not newline terminated.
+                remaining = line[:-len(self.sentinel) - 1]
+                if remaining:
+                    yield remaining
+                break
+
+            yield line
+
+    async def stop(self):
+        if self.alive:
+            self.process.stdin.close()
+            await self.process.wait()
+
+
+class OutputCoalescer:
+    """Batch output lines into larger writes.
+
+    Buffered lines are written when flush_delay has elapsed since the first pending line, when max_size is reached, or
+    when flush() is called at the end of the script.
+    """
+
+    def __init__(self, writer, flush_delay=0.02, max_size=4096):
+        self.writer = writer
+        self.flush_delay = flush_delay
+        self.max_size = max_size
+        self.pending = []
+        self.pending_size = 0
+        self.timer = None
+
+    async def write(self, line):
+        self.pending.append(line)
+        self.pending_size += len(line)
+
+        if self.pending_size >= self.max_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_delay, self._write_pending)
+
+    def _write_pending(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.pending:
+            # transport keeps whatever the socket did not accept, nothing is lost on short writes.
+            self.writer.write(''.join(self.pending).encode())
+            self.pending = []
+            self.pending_size = 0
+
+    async def flush(self):
+        self._write_pending()
+        await self.writer.drain()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class FilterwheelServer:
+    """Asyncio tcp server, accepting several clients and serializing the access to the hardware."""
+
+    def __init__(self, host, port, flush_delay=0.02, script_timeout=120):
+        self.host = host
+        self.port = port
+        self.flush_delay = flush_delay
+        # one worker per script of the largest parallel request.
+        self.workers = [ScriptWorker(timeout=script_timeout) for i in range(max(map(len, parallel_requests.values())))]
+        self.worker = self.workers[0]
+        self.hardware_lock = asyncio.Lock()
+
+    async def execute_parallel(self, scripts):
+        """Execute scripts concurrently, one per worker, and stream their tagged output as it comes."""
+        queue = asyncio.Queue()
+
+        async def run(worker, script):
+            try:
+                async for line in worker.run(script):
+                    await queue.put(tag_line(script, line))
+            finally:
+                await queue.put(None)
+
+        tasks = [asyncio.create_task(run(worker, script)) for worker, script in zip(self.workers, scripts)]
+        running = len(tasks)
+
+        try:
+            while running:
+                line = await queue.get()
+                if line is None:
+                    running -= 1
+                    continue
+                yield line
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def execute(self, script_name):
+        """Execute request in the workers, expanding batched and parallel requests."""
+        if script_name in parallel_requests:
+            async for output_line in self.execute_parallel(parallel_requests[script_name]):
+                yield output_line
+            return
+
+        if script_name not in batched_requests:
+            async for output_line in self.worker.run(script_name):
+                yield output_line
+            return
+
+        values = []
+        for script in batched_requests[script_name]:
+            values.append(last_value([line async for line in self.worker.run(script)]))
+
+        yield f"{','.join(values)}\n"
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        output = OutputCoalescer(writer, flush_delay=self.flush_delay)
+        print(f"Connection established with {addr}")
+
+        try:
+            while True:
+                recv = await reader.readline()
+                if not recv:
+                    break
+
+                script_name = recv.decode().strip()
+                if not script_name:
+                    continue
+
+                print(f"Received request to execute script: {script_name}")
+
+                async with self.hardware_lock:
+                    async for output_line in self.execute(script_name):
+                        await output.write(output_line)
+
+                    await output.flush()
+
+        except ConnectionError as e:
+            print(f"Connection with {addr} lost: {e}")
+
+        finally:
+            output.cancel()
+            print(f"closing connection with {addr}")
+            writer.close()
+
+    async def serve(self):
+        for worker in self.workers:
+            await worker.start()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, reuse_address=True)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        print(f"Server is listening on {self.host}:{self.port}")
+
+        async with server:
+            await stop.wait()
+
+        print("Shutting down the server...")
+        for worker in self.workers:
+            await worker.stop()
+
+
 def signal_handler(sig, frame, server_socket):
     print("Shutting down the server...")
     if server_socket:
@@ -20,10 +285,8 @@ def signal_handler(sig, frame, server_socket):
     sys.exit(0)
 
 
-def main():
-    host = 'filterwheel-dcb'
-    port = 9000
-
+def serve_serial(host, port):
+    """Legacy server, one connection at a time and one subprocess per request."""
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((host, port))
@@ -47,8 +310,8 @@ def main():
                 script_name, _ = recv.split('\r\n')
                 print(f"Received request to execute script: {script_name}")
 
-                for output_line in execute_script(script_name):
-                    conn.send(f"{output_line}".encode())
+                for output_line in execute_request(script_name):
+                    conn.sendall(f"{output_line}".encode())
 
             print('closing connection')
             conn.close()
@@ -59,5 +322,24 @@ def main():
         raise
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='filterwheel-dcb', type=str, help='interface to listen on')
+    parser.add_argument('--port', default=9000, type=int, help='port to listen on')
+    parser.add_argument('--mode', default='async', choices=['async', 'serial'],
+                        help='async: concurrent clients and persistent worker, serial: legacy server')
+    parser.add_argument('--flush-delay', default=20, type=float,
+                        help='maximum time (ms) output lines are held before being sent, async mode only')
+    parser.add_argument('--script-timeout', default=120, type=float,
+                        help='time (s) after which a script is killed, async mode only')
+    args = parser.parse_args()
+
+    if args.mode == 'serial':
+        serve_serial(args.host, args.port)
+    else:
+        asyncio.run(FilterwheelServer(args.host, args.port, flush_delay=args.flush_delay / 1000,
+                                      script_timeout=args.script_timeout).serve())
+
+
 if __name__ == "__main__":
     main()
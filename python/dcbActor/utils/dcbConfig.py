@@ -1,8 +1,60 @@
 __author__ = 'alefur'
 
+import time
+from collections import namedtuple
+
 import dcbActor.utils.makeLamDesign as lamConfig
-import pandas as pd
-from ics.utils import time as pfsTime
+
+# one row per collimator, describing the illumination setup.
+CollConfig = namedtuple('CollConfig', ['setName', 'timestamp', 'iColl', 'fNumber', 'bundle'])
+
+
+class KeyCache(object):
+    """Memoized instdata reads, shared by the collimator sets.
+
+    Cached entries are tagged with the cache version, bumped each time a key is persisted, and are reloaded after
+    maxAge seconds, so keys declared by the other dcb actor are picked up.
+    """
+
+    def __init__(self, actorData, maxAge=5):
+        self.actorData = actorData
+        self.maxAge = maxAge
+        self.version = 0
+        self.entries = dict()
+
+    def load(self, keyName, actorName):
+        """Load persisted key, from the cache if its entry is up to date.
+
+        Raises
+        ------
+        KeyError
+            if the key is not persisted.
+        """
+        now = time.monotonic()
+        entry = self.entries.get((actorName, keyName))
+
+        if entry is None or entry[0] != self.version or now - entry[1] > self.maxAge:
+            try:
+                value = self.actorData.loadKey(keyName, actorName=actorName)
+            except Exception:
+                value = None
+
+            entry = self.version, now, value
+            self.entries[(actorName, keyName)] = entry
+
+        __, __, value = entry
+        if value is None:
+            raise KeyError(f'{keyName} is not persisted for {actorName}')
+
+        return value
+
+    def persist(self, keyName, *values):
+        """Persist key and invalidate the cache."""
+        self.actorData.persistKey(keyName, *values)
+        self.invalidate()
+
+    def invalidate(self):
+        self.version += 1
 
 
 class CollSet(object):
@@ -10,11 +62,12 @@ class CollSet(object):
     nColls = dict(set1=5, set2=5, set3=5, set4=5, oneColl=1)
     knownSets = list(nColls.keys())
 
-    def __init__(self, dcbActor, setName):
+    def __init__(self, dcbActor, setName, keyCache=None):
         if setName not in CollSet.knownSets:
             raise KeyError(f'unkown set:{setName}, valids:{",".join(CollSet.knownSets)}')
 
         self.dcbActor = dcbActor
+        self.keyCache = KeyCache(dcbActor.actorData) if keyCache is None else keyCache
         self.setName = setName
         self.setId = CollSet.knownSets.index(setName) + 1
         self.nColls = CollSet.nColls[setName]
@@ -57,7 +110,7 @@ class CollSet(object):
             f-Numbers values.
         """
         try:
-            fNumbers = self.dcbActor.actorData.loadKey(self.masksKey, actorName=dcb)
+            fNumbers = self.keyCache.load(self.masksKey, actorName=dcb)
         except:
             fNumbers = 0, ('none',) * self.nColls
 
@@ -88,35 +141,63 @@ class CollSet(object):
             plugged fiber bundle.
         """
         try:
-            bundles = self.dcbActor.actorData.loadKey(self.bundlesKey, actorName=self.dcbActor.name)
+            bundles = self.keyCache.load(self.bundlesKey, actorName=self.dcbActor.name)
         except:
             bundles = 0, ('none',) * self.nColls
 
         return bundles
 
-    def declareMasks(self, cmd, fNumbers, colls=None):
-        """Persist masks configuration for that collimator set.
+    def applyConfig(self, config, values, colls=None):
+        """Apply values to matching collimators, without persisting anything.
 
         Parameters
         ----------
-        cmd :
-            mhs command.
+        config : iterable of `str`
+            current collimator set config.
+        values : list of `str`
+            values to apply.
         colls : iterable of `int`
             matching collimator ids.
-        fNumber : `str`
-            fNumber value to apply.
+
+        Returns
+        -------
+        config : list of `str`
+            updated collimator set config.
+
+        Raises
+        ------
+        ValueError
+            if values do not match collimators or a collimator is unknown.
         """
+        config = list(config)
+
         iColls = self.iColls if colls is None else colls
+        if len(values) != len(iColls):
+            raise ValueError(f'len(values):{len(values)} has to match nColls:{len(iColls)}')
 
-        for iColl, fNumber in zip(iColls, fNumbers):
-            try:
-                fNumbers[iColl - 1] = fNumber
-            except IndexError:
+        for iColl, value in zip(iColls, values):
+            if iColl not in self.iColls:
                 raise ValueError(f'unknown coll{iColl} for {self.setName}, valids:{",".join(map(str, self.iColls))}')
 
-            cmd.inform(f'text="declaring {fNumber} for {self.setName}:coll{iColl}')
+            config[iColl - 1] = value
+
+        return config
+
+    def declareMasks(self, cmd, fNumbers, colls=None):
+        """Persist masks configuration for that collimator set.
 
-        self.dcbActor.actorData.persistKey(self.masksKey, float(pfsTime.Time.now().mjd), fNumbers)
+        Parameters
+        ----------
+        cmd :
+            mhs command.
+        colls : iterable of `int`
+            matching collimator ids.
+        fNumbers : list of `str`
+            fNumber values to apply.
+        """
+        transaction = ConfigTransaction(self.keyCache)
+        transaction.stageMasks(self, fNumbers, colls=colls)
+        transaction.commit(cmd)
 
     def declareBundles(self, cmd, bundleSet, colls=None):
         """Persist fiber bundles configuration for that collimator set.
@@ -130,21 +211,24 @@ class CollSet(object):
         bundleSet : list of `str`
             list of fiber bundle.
         """
-        bundles = list(self.bundles)
+        transaction = ConfigTransaction(self.keyCache)
+        transaction.stageBundles(self, bundleSet, colls=colls)
+        transaction.commit(cmd)
 
-        iColls = self.iColls if colls is None else colls
-        if len(bundleSet) != len(iColls):
-            raise ValueError(f'len(bundleSet):{len(bundleSet)} has to match nColls:{len(iColls)}')
+    def rows(self):
+        """Describe collimator set, one row per collimator.
 
-        for iColl, bundle in zip(iColls, bundleSet):
-            try:
-                bundles[iColl - 1] = bundle
-            except IndexError:
-                raise ValueError(f'unknown coll{iColl} for {self.setName}, valids:{",".join(map(str, self.iColls))}')
-
-            cmd.inform(f'text="declaring {bundle} for {self.setName}:coll{iColl}')
+        Returns
+        -------
+        rows : list of `CollConfig`
+            collimator set config.
+        """
+        timestamp1, fNumbers = self.compareFNumbers()
+        timestamp2, bundles = self.loadBundles()
+        timestamp = max(timestamp1, timestamp2)
 
-        self.dcbActor.actorData.persistKey(self.bundlesKey, float(pfsTime.Time.now().mjd), bundles)
+        return [CollConfig(self.setName, timestamp, i + 1, fNbr, bndl)
+                for i, (fNbr, bndl) in enumerate(zip(fNumbers, bundles))]
 
     def dataFrame(self):
         """Generate pandas dataframe describing collimator set
@@ -154,12 +238,8 @@ class CollSet(object):
         df :
             pd.DataFrame
         """
-        timestamp1, fNumbers = self.compareFNumbers()
-        timestamp2, bundles = self.loadBundles()
-        timestamp = max(timestamp1, timestamp2)
-
-        table = [(self.setName, timestamp, i + 1, fNbr, bndl) for i, (fNbr, bndl) in enumerate(zip(fNumbers, bundles))]
-        return pd.DataFrame(table, columns=['setName', 'timestamp', 'iColl', 'fNumber', 'bundle'])
+        import pandas as pd
+        return pd.DataFrame(self.rows(), columns=CollConfig._fields)
 
     def genKeys(self, cmd):
         """Generate per collimator set keywords.
@@ -173,6 +253,79 @@ class CollSet(object):
         cmd.inform(f'{self.bundlesKey}={",".join(list(self.bundles))}')
 
 
+class ConfigTransaction(object):
+    """Collimator sets update, staged and validated first, then persisted with a single timestamp.
+
+    Each key is written once whatever the number of staged changes, keys already written are restored if a write fails.
+    """
+
+    def __init__(self, keyCache):
+        self.keyCache = keyCache
+        self.staged = dict()
+        self.messages = []
+
+    def stage(self, collSet, keyName, previous, config, values, colls=None):
+        """Apply values on top of the staged config for that key.
+
+        Parameters
+        ----------
+        collSet : `CollSet`
+            matching collimator set.
+        keyName : `str`
+            persisted key.
+        previous : tuple
+            persisted (timestamp, config), restored on failure.
+        config : iterable of `str`
+            current config, if nothing is staged yet for that key.
+        values : list of `str`
+            values to apply.
+        colls : iterable of `int`
+            matching collimator ids.
+        """
+        previous, config = self.staged.get(keyName, (previous, config))
+        self.staged[keyName] = previous, collSet.applyConfig(config, values, colls=colls)
+
+        iColls = collSet.iColls if colls is None else colls
+        self.messages.extend([f'text="declaring {value} for {collSet.setName}:coll{iColl}'
+                              for iColl, value in zip(iColls, values)])
+
+    def stageMasks(self, collSet, fNumbers, colls=None):
+        """Stage new fNumbers, masks being shared by both dcb the most recent config is updated."""
+        previous = collSet.loadFNumbers(collSet.dcbActor.name)
+        self.stage(collSet, collSet.masksKey, previous, collSet.fNumbers, fNumbers, colls=colls)
+
+    def stageBundles(self, collSet, bundleSet, colls=None):
+        """Stage new bundles."""
+        previous = collSet.loadBundles()
+        timestamp, bundles = previous
+        self.stage(collSet, collSet.bundlesKey, previous, bundles, bundleSet, colls=colls)
+
+    def commit(self, cmd):
+        """Persist staged keys with a single timestamp, restoring written keys on failure.
+
+        Parameters
+        ----------
+        cmd :
+            mhs command.
+        """
+        from ics.utils import time as pfsTime
+
+        timestamp = float(pfsTime.Time.now().mjd)
+        written = []
+
+        try:
+            for keyName, (previous, config) in self.staged.items():
+                self.keyCache.persist(keyName, timestamp, config)
+                written.append((keyName, previous))
+        except:
+            for keyName, previous in reversed(written):
+                self.keyCache.persist(keyName, *previous)
+            raise
+
+        for message in self.messages:
+            cmd.inform(message)
+
+
 class DcbConfig(object):
     """Placeholder to handle dcb collimators configuration"""
 
@@ -186,7 +339,9 @@ class DcbConfig(object):
 
     def __init__(self, actor):
         self.actor = actor
+        self.keyCache = KeyCache(actor.actorData)
         self.collSetDict = self.fetchIlluminationSetup()
+        self.pfiDesignId = None
 
     @property
     def setNames(self):
@@ -206,10 +361,16 @@ class DcbConfig(object):
     def fetchCollSets(self, setup):
         """Instantiate Collimator Sets from loaded dcb setup."""
         setNames = self.actor.actorConfig['setups'][setup]
-        return dict([(setName, CollSet(self.actor, setName)) for setName in setNames])
+        return dict([(setName, CollSet(self.actor, setName, keyCache=self.keyCache)) for setName in setNames])
+
+    def validateSetNames(self, setNames):
+        """Make sure collimator sets are part of the current setup."""
+        for setName in setNames:
+            if setName not in self.setNames:
+                raise RuntimeError(f'{setName} is not into {self.actor.name} setup, valids:{",".join(self.setNames)}')
 
     def declareMasks(self, cmd, colls=None, **fNumbers):
-        """Persist new dcbMasks for multiple collimator sets.
+        """Persist new dcbMasks for multiple collimator sets, all or nothing.
 
         Parameters
         ----------
@@ -220,33 +381,53 @@ class DcbConfig(object):
         fNumbers : dict
             fNumber value per collimator set.
         """
+        self.validateSetNames(fNumbers.keys())
+        transaction = ConfigTransaction(self.keyCache)
+
         for setName, fNumber in fNumbers.items():
-            if setName not in self.setNames:
-                raise RuntimeError(f'{setName} is not into {self.actor.name} setup, valids:{",".join(self.setNames)}')
+            transaction.stageMasks(self.collSetDict[setName], fNumber, colls=colls)
+
+        transaction.commit(cmd)
 
-            self.collSetDict[setName].declareMasks(cmd, fNumber, colls=colls)
+    def bundleIndex(self):
+        """Index plugged bundles over collimator sets.
 
-    def ensureBundleIsUnic(self, cmd, bundleSets):
+        Returns
+        -------
+        index : dict
+            list of (setName, iColl) per bundle.
+        """
+        index = dict()
+
+        for collSet in self.collSets:
+            for iColl, bundle in zip(collSet.iColls, collSet.bundles):
+                index.setdefault(bundle, []).append((collSet.setName, iColl))
+
+        return index
+
+    def ensureBundleIsUnic(self, transaction, bundleSets):
         """dcb cables has only one bundle each, make sure that's the case.
 
         Parameters
         ----------
-        cmd :
-            mhs command.
+        transaction : `ConfigTransaction`
+            transaction where evictions are staged.
         bundleSets : dict
             bundle list per collimator set.
         """
-        for collSet in self.collSets:
-            for setName, bundleSet in bundleSets.items():
-                for bundle in bundleSet:
-                    try:
-                        index = collSet.bundles.index(bundle)
-                        collSet.declareBundles(cmd, ['none'], [index + 1])
-                    except ValueError:
-                        continue
+        index = self.bundleIndex()
+        requested = set(bundle for bundleSet in bundleSets.values() for bundle in bundleSet) - {'none'}
+        evictions = dict()
+
+        for bundle in requested:
+            for setName, iColl in index.get(bundle, []):
+                evictions.setdefault(setName, []).append(iColl)
+
+        for setName, colls in evictions.items():
+            transaction.stageBundles(self.collSetDict[setName], ['none'] * len(colls), colls=sorted(colls))
 
     def declareBundles(self, cmd, colls=None, **bundleSets):
-        """Persist new dcb bundles configuration for multiple collimator sets.
+        """Persist new dcb bundles configuration for multiple collimator sets, all or nothing.
 
         Parameters
         ----------
@@ -257,13 +438,25 @@ class DcbConfig(object):
         bundleSets : dict
             bundle list per collimator set.
         """
-        self.ensureBundleIsUnic(cmd, bundleSets)
+        self.validateSetNames(bundleSets.keys())
+        transaction = ConfigTransaction(self.keyCache)
+
+        self.ensureBundleIsUnic(transaction, bundleSets)
 
         for setName, bundleSet in bundleSets.items():
-            if setName not in self.setNames:
-                raise RuntimeError(f'{setName} is not into {self.actor.name} setup, valids:{",".join(self.setNames)}')
+            transaction.stageBundles(self.collSetDict[setName], bundleSet, colls=colls)
+
+        transaction.commit(cmd)
 
-            self.collSetDict[setName].declareBundles(cmd, bundleSet, colls=colls)
+    def setupRows(self):
+        """Describe dcb illumination setup, one row per collimator.
+
+        Returns
+        -------
+        rows : list of `CollConfig`
+            illumination setup.
+        """
+        return sum([collSet.rows() for collSet in self.collSets], [])
 
     def dcbSetup(self):
         """Generate pandas dataframe describing dcb illumination setup
@@ -273,7 +466,8 @@ class DcbConfig(object):
         df :
             pd.DataFrame
         """
-        return pd.concat([collSet.dataFrame() for collSet in self.collSets]).reset_index(drop=True)
+        import pandas as pd
+        return pd.DataFrame(self.setupRows(), columns=CollConfig._fields)
 
     def genKeys(self, cmd):
         """Generate dcb config keywords.
@@ -283,32 +477,28 @@ class DcbConfig(object):
         cmd :
             mhs command.
         """
-
-        def mergeCollSetConfig(config):
-            """Merge collimator sets config to a single list."""
-            allCollConfig = 12 * ['none']
-
-            for iColl, value in zip(config.index, config):
-                allCollConfig[iColl] = value
-
-            return allCollConfig
-
         for collSet in self.collSets:
             collSet.genKeys(cmd)
 
-        dcbSetup = self.dcbSetup()
-        dcbKeys = dcbSetup.query('bundle!="none"')
-
+        dcbSetup = self.setupRows()
         # Merge collSet config and preserve collimator index (INSTRM-2166)
-        dcbMasks = mergeCollSetConfig(dcbKeys.fNumber)
-        dcbBundles = mergeCollSetConfig(dcbKeys.bundle)
+        dcbKeys = [(index, row) for index, row in enumerate(dcbSetup) if row.bundle != 'none']
+
+        dcbMasks = 12 * ['none']
+        dcbBundles = 12 * ['none']
+
+        for index, row in dcbKeys:
+            dcbMasks[index] = row.fNumber
+            dcbBundles[index] = row.bundle
 
-        dcbConfigDate = dcbSetup.timestamp.max()
+        dcbConfigDate = max(row.timestamp for row in dcbSetup)
 
-        colors = dcbKeys.bundle.values.tolist()
-        pfiDesignId = lamConfig.hashColors(colors)
-        # Persisting pfsDesignId.
-        self.actor.actorData.persistKey('pfsDesignId', '0x%016x' % pfiDesignId)
+        colors = [row.bundle for index, row in dcbKeys]
+        pfiDesignId = lamConfig.designFromColors(colors).designId
+        # Persisting pfsDesignId, only when it has changed.
+        if pfiDesignId != self.pfiDesignId:
+            self.actor.actorData.persistKey('pfsDesignId', '0x%016x' % pfiDesignId)
+            self.pfiDesignId = pfiDesignId
 
         cmd.inform('designId=0x%016x' % pfiDesignId)
         cmd.inform('fiberConfig="%s"' % ';'.join(colors))
@@ -3,21 +3,30 @@
 """
 Executable script to create a PfiDesign for a LAM exposure, given the colors
 of fibers used.
+
+It also exports the table of every design reachable with the dcb collimator slots, which can be memory-mapped by
+consumers instead of recomputing fiber lists:
+
+    python makeLamDesign.py --output lamDesigns.npy
 """
 
-import numpy as np
+import argparse
+from functools import cached_property, lru_cache
+
+# numpy is imported on first use, fiber lists and hashes being pure python so importing that module stays cheap.
 
 # Mapping of colors to fiberIds
 # Constructed from a snippet by Fabrice Madec, "dummy cable B fibers"
 # https://sumire-pfs.slack.com/files/U3MLENNHH/FFS6P4UR5/dummy_cable_b_fibers.txt
 
-allFibers = list(np.arange(1, 652))
-blank = [44, 91, 93, 136, 183, 185, 228, 272] + list(np.arange(317, 336)) + [383, 427, 470, 472, 516, 559, 561, 608]
+NFIBERS = 651
+allFibers = list(range(1, NFIBERS + 1))
+blank = [44, 91, 93, 136, 183, 185, 228, 272] + list(range(317, 336)) + [383, 427, 470, 472, 516, 559, 561, 608]
 blank34 = [281, 309, 359]
 engineering = [1, 45, 92, 137, 184, 229, 273, 316, 336, 382, 426, 471, 515, 560, 607, 651]
-science = np.array([fib for fib in allFibers if fib not in engineering + blank])
-mtp9 = list(science[science < 273])
-mtp12 = list(science[science > 273])
+science = sorted(set(allFibers) - set(engineering) - set(blank))
+mtp9 = [fib for fib in science if fib < 273]
+mtp12 = [fib for fib in science if fib > 273]
 
 FIBER_COLORS = {"red1": [2],
                 "red2": [3],
@@ -44,6 +53,21 @@ sortedKeys = ['blue', 'green', 'orange', 'red1', 'red2', 'red3', 'red4', 'red5',
 HASH_COLORS = {color: 16 ** ii for ii, color in enumerate(sortedKeys)}
 
 
+def fiberMask(fiberIds):
+    """Convert fiber IDs to a boolean mask over all fibers, fiberId-1 being the index."""
+    import numpy as np
+
+    mask = np.zeros(NFIBERS, dtype=bool)
+    mask[np.asarray(fiberIds, dtype=int) - 1] = True
+    return mask
+
+
+@lru_cache(maxsize=None)
+def fiberMasks():
+    """Mapping of colors to fiber boolean masks, built on first use."""
+    return {color: fiberMask(fiberIds) for color, fiberIds in FIBER_COLORS.items()}
+
+
 def colorsToFibers(colors):
     """Convert a list of colors to an array of fiber IDs
     Parameters
@@ -55,7 +79,15 @@ def colorsToFibers(colors):
     fiberId : `numpy.ndarray`
         Array of fiber IDs.
     """
-    return np.array(sorted(set(sum([FIBER_COLORS[col] for col in colors], []))))
+    import numpy as np
+
+    masks = fiberMasks()
+    mask = np.zeros(NFIBERS, dtype=bool)
+
+    for col in set(colors):
+        mask |= masks[col]
+
+    return np.flatnonzero(mask) + 1
 
 
 def hashColors(colors):
@@ -70,3 +102,153 @@ def hashColors(colors):
         Hash, for the pfiDesignId.
     """
     return sum(HASH_COLORS[col] for col in set(colors))
+
+
+class LamDesign(object):
+    """Design for a given color set, fiberId is computed on first access."""
+
+    def __init__(self, colors):
+        self.colors = tuple(color for color in sortedKeys if color in colors)
+        self.designId = hashColors(self.colors)
+
+    @cached_property
+    def fiberId(self):
+        """Read-only array of fiber IDs, since it is shared by every caller."""
+        fiberId = colorsToFibers(self.colors)
+        fiberId.setflags(write=False)
+        return fiberId
+
+
+@lru_cache(maxsize=256)
+def _designFromColorSet(colorSet):
+    return LamDesign(colorSet)
+
+
+def designFromColors(colors):
+    """Return the design matching a list of colors, computed once per color set.
+    Parameters
+    ----------
+    colors : iterable of `str`
+        List of colors.
+    Returns
+    -------
+    design : `LamDesign`
+        designId, colors in sortedKeys order and read-only array of fiber IDs.
+    """
+    colorSet = frozenset(colors)
+    unknown = colorSet - HASH_COLORS.keys()
+    if unknown:
+        raise KeyError(f'unknown colors:{",".join(sorted(unknown))}, valids:{",".join(sortedKeys)}')
+
+    return _designFromColorSet(colorSet)
+
+
+def designFromId(designId):
+    """Decode a pfiDesignId back to its design.
+    Parameters
+    ----------
+    designId : `int` or `str`
+        pfiDesignId, as an integer or an hexadecimal string.
+    Returns
+    -------
+    design : `LamDesign`
+        designId, colors in sortedKeys order and read-only array of fiber IDs.
+    """
+    designId = int(designId, 16) if isinstance(designId, str) else int(designId)
+    colors = [color for color in sortedKeys if designId // HASH_COLORS[color] % 16]
+
+    if hashColors(colors) != designId:
+        raise ValueError(f'0x{designId:016x} is not a lam pfiDesignId')
+
+    return _designFromColorSet(frozenset(colors))
+
+
+# Design table row, fibers being the fiber mask packed with np.packbits.
+DESIGN_TABLE_DTYPE = [('designId', '<u8'), ('fibers', 'u1', ((NFIBERS + 7) // 8,))]
+
+
+def designTable(maxColors=12):
+    """Build the table of every design made of at most maxColors colors, sorted by designId.
+    Parameters
+    ----------
+    maxColors : `int`
+        Maximum number of colors, 12 collimator slots by default.
+    Returns
+    -------
+    table : `numpy.ndarray`
+        Structured array of DESIGN_TABLE_DTYPE.
+    """
+    import numpy as np
+
+    nColors = len(sortedKeys)
+    colorSets = np.arange(2 ** nColors, dtype='<u8')
+    # membership of each color in each color set, from the color set bits.
+    used = ((colorSets[:, None] >> np.arange(nColors, dtype='<u8')) & 1).astype(bool)
+    used = used[used.sum(axis=1) <= maxColors]
+
+    designIds = np.zeros(len(used), dtype='<u8')
+    fibers = np.zeros((len(used), NFIBERS), dtype=bool)
+
+    for iColor, color in enumerate(sortedKeys):
+        designIds[used[:, iColor]] += np.uint64(HASH_COLORS[color])
+        fibers[used[:, iColor]] |= fiberMasks()[color]
+
+    table = np.empty(len(used), dtype=DESIGN_TABLE_DTYPE)
+    table['designId'] = designIds
+    table['fibers'] = np.packbits(fibers, axis=1)
+    table.sort(order='designId')
+
+    return table
+
+
+def writeDesignTable(filepath, maxColors=12):
+    """Write the design table as a .npy file."""
+    import numpy as np
+
+    np.save(filepath, designTable(maxColors=maxColors))
+
+
+def loadDesignTable(filepath):
+    """Load the design table, memory-mapped and read-only."""
+    import numpy as np
+
+    return np.load(filepath, mmap_mode='r')
+
+
+def lookupDesign(table, designId):
+    """Find the fiber IDs of a pfiDesignId in the design table.
+    Parameters
+    ----------
+    table : `numpy.ndarray`
+        Design table, as returned by loadDesignTable.
+    designId : `int` or `str`
+        pfiDesignId, as an integer or an hexadecimal string.
+    Returns
+    -------
+    fiberId : `numpy.ndarray`
+        Array of fiber IDs.
+    """
+    import numpy as np
+
+    designId = int(designId, 16) if isinstance(designId, str) else int(designId)
+    # uint64 key, a python int would be compared as float64 and lose the lowest digits.
+    key = np.uint64(designId)
+    index = np.searchsorted(table['designId'], key)
+
+    if index == len(table) or table['designId'][index] != key:
+        raise KeyError(f'0x{designId:016x} is not in the design table')
+
+    return np.flatnonzero(np.unpackbits(table['fibers'][index], count=NFIBERS)) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export the table of lam designs reachable with the dcb')
+    parser.add_argument('--output', default='lamDesigns.npy', type=str, help='output .npy file')
+    parser.add_argument('--maxColors', default=12, type=int, help='maximum number of colors per design')
+    args = parser.parse_args()
+
+    writeDesignTable(args.output, maxColors=args.maxColors)
+
+
+if __name__ == '__main__':
+    main()